@@ -8,22 +8,85 @@ Author: Shreyash Naik (modified for Google Sheets)
 Date: January 8, 2025
 """
 
+import httplib2
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import time
+import orjson
 from datetime import datetime
 import os
 from google.oauth2.credentials import Credentials
 from google.oauth2 import service_account
+from google.auth.exceptions import GoogleAuthError
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+# Columns of the processed rows, as stored in the Parquet history log
+HISTORY_SCHEMA = pa.schema([
+    ('name', pa.string()),
+    ('symbol', pa.string()),
+    ('current_price', pa.float64()),
+    ('market_cap', pa.float64()),
+    ('total_volume', pa.float64()),
+    ('price_change_percentage_24h', pa.float64()),
+    ('last_updated', pa.string())
+])
+
+# Static parts of the analysis pane; only the values are computed per cycle
+_ANALYSIS_HEADER = (("Market Analysis",), ("Top 5 by Market Cap:",))
+_ANALYSIS_LABELS = (
+    "Total Market Cap:",
+    "Average Price:",
+    "Average 24h Volume:",
+    "Market Volatility Index:",
+    "Highest 24h Change:",
+    "Lowest 24h Change:"
+)
+
 class CryptoTrackerGSheets:
     def __init__(self, credentials_path, spreadsheet_id):
         self.base_url = "https://api.coingecko.com/api/v3"
         self.spreadsheet_id = spreadsheet_id
         self.service = self._initialize_sheets_service(credentials_path)
-        
+        self.http = self._initialize_http_session()
+        self._cache_path = '.cache/coingecko_top50_slim.json'
+        self._backoff = 0  # seconds to wait after a failed fetch, 0 after a success
+        self._fetched_fresh = False  # whether the last fetch came from CoinGecko rather than the cache
+        self._prev_rows = {}  # symbol -> (row index, values without timestamp) last written
+        self._prev_analysis = None  # analysis pane last written
+        self._cycle = 0
+        self._history_dir = 'history'
+        self._history_flush_every = 12  # cycles per history file (an hour at the default interval)
+        self._history_rows = []  # rows buffered since the last flush
+        self._history_cycles = 0
+        self._history_started = None
+
+    def _initialize_http_session(self):
+        """Create a persistent HTTP session so keep-alive is reused between polls"""
+        session = requests.Session()
+        retries = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[500, 502, 503, 504],
+            # Let a 429 with Retry-After reach fetch_top_50_data's backoff instead
+            # of the adapter sleeping and retrying into the rate limit
+            respect_retry_after_header=False
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retries)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
+            'User-Agent': 'crypto-tracker/1.0'
+        })
+        return session
+
     def _initialize_sheets_service(self, credentials_path):
         """Initialize Google Sheets service with credentials"""
         try:
@@ -31,13 +94,44 @@ class CryptoTrackerGSheets:
                 credentials_path,
                 scopes=['https://www.googleapis.com/auth/spreadsheets']
             )
-            return build('sheets', 'v4', credentials=credentials)
+            # One persistent, authorized connection with a timeout so a stalled
+            # socket cannot hang the update loop
+            http = AuthorizedHttp(credentials, http=httplib2.Http(timeout=10))
+            return build('sheets', 'v4', http=http, cache_discovery=False)
         except Exception as e:
             print(f"Error initializing Google Sheets service: {e}")
             return None
 
+    def _read_cache(self, ttl=240):
+        """Return (payload, mtime) of the cached CoinGecko response if younger than ttl seconds (any age if ttl is None)"""
+        try:
+            with open(self._cache_path, 'rb') as f:
+                cached = orjson.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+        if ttl is not None and time.time() - cached['ts'] >= ttl:
+            return None
+        return cached['data'], cached['ts']
+
+    def _write_cache(self, payload):
+        """Atomically store the CoinGecko response on disk"""
+        try:
+            os.makedirs(os.path.dirname(self._cache_path), exist_ok=True)
+            tmp_path = f"{self._cache_path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(orjson.dumps({'ts': time.time(), 'data': payload}))
+            os.replace(tmp_path, self._cache_path)
+        except OSError as e:
+            print(f"Error writing cache: {e}")
+
     def fetch_top_50_data(self):
-        """Fetch top 50 cryptocurrencies data from CoinGecko API"""
+        """Fetch top 50 cryptocurrencies data from CoinGecko API (or a recent cached response)"""
+        self._fetched_fresh = False
+        cached = self._read_cache()
+        if cached:
+            return cached[0]
+
         try:
             endpoint = f"{self.base_url}/coins/markets"
             params = {
@@ -48,75 +142,121 @@ class CryptoTrackerGSheets:
                 'sparkline': False
             }
             
-            response = requests.get(endpoint, params=params)
+            response = self.http.get(endpoint, params=params, timeout=(3.05, 10))
+            if response.status_code == 429:
+                # Rate limited: wait at least as long as CoinGecko asks before polling again
+                try:
+                    retry_after = int(response.headers.get('Retry-After', '30'))
+                except ValueError:
+                    retry_after = 30
+                print(f"Rate limited by CoinGecko, retrying after {retry_after} seconds")
+                return self._fetch_failed(retry_after)
+
             response.raise_for_status()
-            return response.json()
+            # Keep only the fields we use: (name, symbol, price, market cap, volume, 24h change %)
+            payload = [
+                (c['name'], c['symbol'], c['current_price'], c['market_cap'],
+                 c['total_volume'], c['price_change_percentage_24h'])
+                for c in orjson.loads(response.content)
+            ]
+            self._write_cache(payload)
+            self._backoff = 0
+            self._fetched_fresh = True
+            return payload
             
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError, KeyError, TypeError) as e:
             print(f"Error fetching data: {e}")
-            return None
+            return self._fetch_failed()
+
+    def _fetch_failed(self, min_backoff=10):
+        """Grow the backoff after a failed fetch and fall back to the last known good response"""
+        self._backoff = max(min_backoff, min(300, self._backoff * 2))
+        # Return the stale cache so the sheet keeps showing prior data
+        stale = self._read_cache(ttl=None)
+        return stale[0] if stale else None
 
     def process_crypto_data(self, data):
-        """Process raw API data into a structured format"""
+        """Process fetched (name, symbol, price, market cap, volume, change) records into sheet rows"""
         if not data:
             return None
             
-        processed_data = []
-        for coin in data:
-            processed_data.append([
-                coin['name'],
-                coin['symbol'].upper(),
-                coin['current_price'],
-                coin['market_cap'],
-                coin['total_volume'],
-                coin['price_change_percentage_24h'],
-                datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            ])
-            
-        return processed_data
+        now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        return [
+            [name, symbol.upper(), price, market_cap, volume, change, now_str]
+            for name, symbol, price, market_cap, volume, change in data
+        ]
+
+    def append_history(self, data):
+        """Buffer processed rows for the Parquet history log, flushing every few cycles"""
+        if not data:
+            return
+
+        if not self._history_rows:
+            self._history_started = datetime.now()
+        self._history_rows.extend(data)
+        self._history_cycles += 1
+        if self._history_cycles >= self._history_flush_every:
+            self.flush_history()
+
+    def flush_history(self):
+        """Write buffered rows to a self-contained history/<start>.parquet file"""
+        if not self._history_rows:
+            return
+
+        rows = self._history_rows
+        path = os.path.join(self._history_dir, f"{self._history_started.strftime('%Y-%m-%d_%H%M%S')}.parquet")
+        self._history_rows = []
+        self._history_cycles = 0
+
+        try:
+            os.makedirs(self._history_dir, exist_ok=True)
+            table = pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(zip(*rows), HISTORY_SCHEMA)],
+                schema=HISTORY_SCHEMA
+            )
+            pq.write_table(table, path, compression='zstd')
+
+        except (OSError, pa.ArrowException) as e:
+            print(f"Error writing history: {e}")
 
     def analyze_data(self, data):
         """Perform analysis on cryptocurrency data"""
         if not data:
             return None
             
-        df = pd.DataFrame(data, columns=[
-            'Name', 'Symbol', 'Current Price (USD)', 'Market Cap', 
-            '24h Volume', '24h Change %', 'Last Updated'
-        ])
-            
-        analysis = [
-            ["Market Analysis"],
-            ["Top 5 by Market Cap:"],
-        ]
-        
-        # Add top 5 by market cap
-        top_5 = df.nlargest(5, 'Market Cap')
-        for _, row in top_5.iterrows():
-            analysis.append([f"{row['Name']}: ${row['Market Cap']:,.2f}"])
-        
-        analysis.extend([
-            [""],
-            [f"Total Market Cap: ${df['Market Cap'].sum():,.2f}"],
-            [f"Average Price: ${df['Current Price (USD)'].mean():,.2f}"],
-            [f"Average 24h Volume: ${df['24h Volume'].mean():,.2f}"],
-            [f"Market Volatility Index: {df['24h Change %'].std():.2f}%"],
-            [""],
-            [f"Highest 24h Change: {df.nlargest(1, '24h Change %').iloc[0]['Name']} ({df.nlargest(1, '24h Change %').iloc[0]['24h Change %']:.2f}%)"],
-            [f"Lowest 24h Change: {df.nsmallest(1, '24h Change %').iloc[0]['Name']} ({df.nsmallest(1, '24h Change %').iloc[0]['24h Change %']:.2f}%)"],
-        ])
-        
+        # Extract the numeric columns once; missing values become NaN
+        columns = list(zip(*data))
+        names = columns[0]
+        price = np.array(columns[2], dtype=np.float64)
+        mcap = np.array(columns[3], dtype=np.float64)
+        vol = np.array(columns[4], dtype=np.float64)
+        chg = np.array(columns[5], dtype=np.float64)
+
+        analysis = list(_ANALYSIS_HEADER)
+
+        # Add top 5 by market cap (partition first, then order just those five)
+        ranked = -np.nan_to_num(mcap, nan=-np.inf)
+        k = min(5, len(ranked))
+        top_5 = np.argpartition(ranked, k - 1)[:k]
+        for i in top_5[np.argsort(ranked[top_5])]:
+            analysis.append((names[i], float(mcap[i])))
+
+        highest = int(np.nanargmax(chg))
+        lowest = int(np.nanargmin(chg))
+
+        stats = (np.nansum(mcap), np.nanmean(price), np.nanmean(vol), np.nanstd(chg, ddof=1))
+
+        analysis.append(("",))
+        analysis.extend((label, float(value)) for label, value in zip(_ANALYSIS_LABELS[:4], stats))
+        analysis.append(("",))
+        analysis.append((_ANALYSIS_LABELS[4], float(chg[highest]), names[highest]))
+        analysis.append((_ANALYSIS_LABELS[5], float(chg[lowest]), names[lowest]))
+
         return analysis
 
     def initialize_sheet(self):
         """Initialize Google Sheet with headers and formatting"""
         try:
-            # Clear the sheet
-            self.service.spreadsheets().values().clear(
-                spreadsheetId=self.spreadsheet_id,
-                range='Sheet1'
-            ).execute()
-
             # Set up headers
             headers = [
                 ['Cryptocurrency Live Data Tracker'],
@@ -125,93 +265,177 @@ class CryptoTrackerGSheets:
                  '24h Volume', '24h Change %', 'Last Updated']
             ]
 
-            self.service.spreadsheets().values().update(
-                spreadsheetId=self.spreadsheet_id,
-                range='A1',
-                valueInputOption='RAW',
-                body={'values': headers}
-            ).execute()
-
-            # Apply formatting (bold headers)
-            requests = [{
-                'repeatCell': {
-                    'range': {
-                        'sheetId': 0,
-                        'startRowIndex': 0,
-                        'endRowIndex': 1,
-                        'startColumnIndex': 0,
-                        'endColumnIndex': 7
-                    },
-                    'cell': {
-                        'userEnteredFormat': {
-                            'textFormat': {'bold': True}
-                        }
-                    },
-                    'fields': 'userEnteredFormat.textFormat.bold'
-                }
-            }]
+            # Clear the sheet, write headers and apply formatting (bold headers)
+            # in a single request
+            requests = [
+                {
+                    'updateCells': {
+                        'range': {'sheetId': 0},
+                        'fields': 'userEnteredValue'
+                    }
+                },
+                {
+                    'updateCells': {
+                        'start': {'sheetId': 0, 'rowIndex': 0, 'columnIndex': 0},
+                        'rows': [
+                            {'values': [{'userEnteredValue': {'stringValue': value}} for value in row]}
+                            for row in headers
+                        ],
+                        'fields': 'userEnteredValue'
+                    }
+                },
+                {
+                    'repeatCell': {
+                        'range': {
+                            'sheetId': 0,
+                            'startRowIndex': 0,
+                            'endRowIndex': 1,
+                            'startColumnIndex': 0,
+                            'endColumnIndex': 7
+                        },
+                        'cell': {
+                            'userEnteredFormat': {
+                                'textFormat': {'bold': True}
+                            }
+                        },
+                        'fields': 'userEnteredFormat.textFormat.bold'
+                    }
+                },
+                # USD columns of the data range: price (with extra precision for
+                # sub-cent coins), then market cap and volume
+                self._number_format_request(3, None, 2, 3, 'CURRENCY', '"$"#,##0.00######'),
+                self._number_format_request(3, None, 3, 5, 'CURRENCY', '"$"#,##0.00'),
+                # Analysis values: USD figures, then percentages
+                self._number_format_request(2, 11, 9, 10, 'CURRENCY', '"$"#,##0.00'),
+                self._number_format_request(11, 15, 9, 10, 'NUMBER', '0.00"%"')
+            ]
 
             self.service.spreadsheets().batchUpdate(
                 spreadsheetId=self.spreadsheet_id,
                 body={'requests': requests}
             ).execute()
 
+            self._prev_rows = {}
+            self._prev_analysis = None
             return True
 
-        except HttpError as e:
+        except (HttpError, GoogleAuthError, OSError, httplib2.HttpLib2Error) as e:
             print(f"Error initializing Google Sheet: {e}")
             return False
 
-    def update_sheet(self, data, analysis):
-        """Update Google Sheet with latest data and analysis"""
+    @staticmethod
+    def _number_format_request(start_row, end_row, start_col, end_col, format_type, pattern):
+        """Build a repeatCell request applying a number format to a block of Sheet1"""
+        grid_range = {
+            'sheetId': 0,
+            'startRowIndex': start_row,
+            'startColumnIndex': start_col,
+            'endColumnIndex': end_col
+        }
+        if end_row is not None:
+            grid_range['endRowIndex'] = end_row
+
+        return {
+            'repeatCell': {
+                'range': grid_range,
+                'cell': {
+                    'userEnteredFormat': {
+                        'numberFormat': {'type': format_type, 'pattern': pattern}
+                    }
+                },
+                'fields': 'userEnteredFormat.numberFormat'
+            }
+        }
+
+    def update_sheet(self, data, analysis=None):
+        """Update Google Sheet with changed data rows and, if given and changed, the analysis"""
+        if not data:
+            return
+
+        # Only rows that moved or whose values (excluding the timestamp) changed
+        # since the last successful write need to be pushed
+        changed = [
+            i for i, row in enumerate(data)
+            if self._prev_rows.get(row[1]) != (i, row[:-1])
+        ]
+        write_analysis = analysis is not None and analysis != self._prev_analysis
+        if not changed and not write_analysis:
+            return
+
         try:
-            # Update main data
-            self.service.spreadsheets().values().update(
+            # Update changed rows and analysis in a single request
+            self.service.spreadsheets().values().batchUpdate(
                 spreadsheetId=self.spreadsheet_id,
-                range='A4',
-                valueInputOption='RAW',
-                body={'values': data}
+                body={
+                    'valueInputOption': 'RAW',
+                    'data': [
+                        {'range': f'Sheet1!A{4 + i}:G{4 + i}', 'values': [data[i]]}
+                        for i in changed
+                    ] + (
+                        [{'range': 'Sheet1!I1', 'values': analysis}] if write_analysis else []
+                    )
+                }
             ).execute()
 
-            # Update analysis
-            self.service.spreadsheets().values().update(
-                spreadsheetId=self.spreadsheet_id,
-                range='I1',
-                valueInputOption='RAW',
-                body={'values': analysis}
-            ).execute()
+            self._prev_rows = {row[1]: (i, row[:-1]) for i, row in enumerate(data)}
+            if write_analysis:
+                self._prev_analysis = analysis
 
-        except HttpError as e:
+        except (HttpError, GoogleAuthError, OSError, httplib2.HttpLib2Error) as e:
             print(f"Error updating Google Sheet: {e}")
 
-    def run_tracker(self, update_interval=300):
-        """Run the crypto tracker with specified update interval (in seconds)"""
+    def run_tracker(self, update_interval=300, analysis_every=3):
+        """Run the crypto tracker with specified update interval (in seconds)
+
+        The analysis pane is recomputed and written every `analysis_every` cycles;
+        the data pane is updated every cycle.
+        """
         if not self.initialize_sheet():
             return
 
-        print(f"Cryptocurrency tracker started. Data will be updated every {update_interval} seconds.")
-        print("Press Ctrl+C to stop.")
+        try:
+
+            print(f"Cryptocurrency tracker started. Data will be updated every {update_interval} seconds.")
+            print("Press Ctrl+C to stop.")
+
+            # Cycles are scheduled on a monotonic clock so they do not drift by the time the work takes
+            next_deadline = time.monotonic()
+            while True:
+                try:
+                    # Fetch and process data
+                    raw_data = self.fetch_top_50_data()
+                    data = self.process_crypto_data(raw_data)
+                    analysis_due = self._cycle % analysis_every == 0
+                    analysis = self.analyze_data(data) if analysis_due else None
+
+                    # Cached payloads were already logged when they were fetched
+                    if self._fetched_fresh:
+                        self.append_history(data)
+
+                    # Update Google Sheet
+                    self.update_sheet(data, analysis)
 
-        while True:
-            try:
-                # Fetch and process data
-                raw_data = self.fetch_top_50_data()
-                data = self.process_crypto_data(raw_data)
-                analysis = self.analyze_data(data)
+                    # A due analysis is retried every cycle until it is on the sheet
+                    if not analysis_due or (analysis is not None and analysis == self._prev_analysis):
+                        self._cycle += 1
 
-                # Update Google Sheet
-                self.update_sheet(data, analysis)
+                    print(f"Data updated at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
-                print(f"Data updated at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-                time.sleep(update_interval)
+                    # Wait longer after a failed fetch; skip slots missed by an overrunning cycle
+                    now = time.monotonic()
+                    next_deadline = max(next_deadline + update_interval, now + self._backoff)
+                    time.sleep(max(0.0, next_deadline - now))
 
-            except KeyboardInterrupt:
-                print("\nCryptocurrency tracker stopped.")
-                break
-            except Exception as e:
-                print(f"Error in main loop: {e}")
-                time.sleep(10)  # Wait before retrying
+                except Exception as e:
+                    print(f"Error in main loop: {e}")
+                    # Wait before retrying
+                    next_deadline = time.monotonic() + (self._backoff or 10)
+                    time.sleep(max(0.0, next_deadline - time.monotonic()))
 
+        except KeyboardInterrupt:
+            print("\nCryptocurrency tracker stopped.")
+        finally:
+            self.flush_history()
 
     @staticmethod
     def verify_setup(credentials_path):